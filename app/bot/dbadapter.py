@@ -1,12 +1,30 @@
+import datetime
 import logging
-from typing import Optional, Set, Iterable
-
-from sqlalchemy import Column, Integer, BigInteger, Boolean, String, JSON, create_engine
+import threading
+import time
+from typing import Dict, List, Optional, Set, FrozenSet, Iterable
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    BigInteger,
+    Boolean,
+    String,
+    JSON,
+    DateTime,
+    create_engine,
+    event,
+    func,
+    inspect,
+    text,
+)
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 
-from . import settings
+from . import rules, settings
 
 # Enable logging
 logging.basicConfig(
@@ -19,32 +37,233 @@ logger = logging.getLogger(__name__)
 Base = declarative_base()
 
 
+class DBStats:
+    """Counts and timings of DB queries and sessions.
+
+    Session DB time is time spent waiting for a pooled connection, in queries and
+    in COMMIT. Session is slow when its DB time is long, time spent outside of DB
+    calls (e.g. in Bot API calls made while session is open) is not counted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # query time per thread, to tell how much of a session was DB work
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.queries = 0
+            self.queries_seconds = 0.0
+            self.max_query_seconds = 0.0
+            self.sessions = 0
+            self.sessions_seconds = 0.0
+            self.sessions_db_seconds = 0.0
+            self.max_session_db_seconds = 0.0
+            self.checkouts_seconds = 0.0
+            self.max_checkout_seconds = 0.0
+            self.commits = 0
+            self.commits_seconds = 0.0
+            self.max_commit_seconds = 0.0
+
+    def record_query(self, seconds: float, statement: str) -> None:
+        with self._lock:
+            self.queries += 1
+            self.queries_seconds += seconds
+            self.max_query_seconds = max(self.max_query_seconds, seconds)
+        self._local.query_seconds = self.thread_query_seconds() + seconds
+        if seconds >= settings.DB_SLOW_QUERY_SECONDS:
+            logger.warning(f"Slow query ({seconds:.3f}s): {statement}")
+
+    def thread_query_seconds(self) -> float:
+        """Total time of queries made by the current thread."""
+        return getattr(self._local, "query_seconds", 0.0)
+
+    def record_session(
+        self,
+        seconds: float,
+        query_seconds: float,
+        checkout_seconds: float,
+        commit_seconds: Optional[float],
+    ) -> None:
+        """Record session timings, ``commit_seconds=None`` if it was not committed.
+
+        ``commit_seconds`` must not include queries flushed on commit.
+        """
+        db_seconds = query_seconds + checkout_seconds + (commit_seconds or 0.0)
+        with self._lock:
+            self.sessions += 1
+            self.sessions_seconds += seconds
+            self.sessions_db_seconds += db_seconds
+            self.max_session_db_seconds = max(self.max_session_db_seconds, db_seconds)
+            self.checkouts_seconds += checkout_seconds
+            self.max_checkout_seconds = max(self.max_checkout_seconds, checkout_seconds)
+            if commit_seconds is not None:
+                self.commits += 1
+                self.commits_seconds += commit_seconds
+                self.max_commit_seconds = max(self.max_commit_seconds, commit_seconds)
+        if db_seconds >= settings.DB_SLOW_SESSION_SECONDS:
+            logger.warning(
+                f"Slow session ({db_seconds:.3f}s in DB of {seconds:.3f}s total: "
+                f"checkout {checkout_seconds:.3f}s, queries {query_seconds:.3f}s, "
+                f"commit {commit_seconds or 0.0:.3f}s)"
+            )
+
+    def __str__(self) -> str:
+        def avg(total: float, count: int) -> float:
+            return total / count * 1000 if count else 0
+
+        return (
+            f"queries={self.queries} "
+            f"avg={avg(self.queries_seconds, self.queries):.1f}ms "
+            f"max={self.max_query_seconds * 1000:.1f}ms\n"
+            f"sessions={self.sessions} "
+            f"avg={avg(self.sessions_seconds, self.sessions):.1f}ms "
+            f"in DB avg={avg(self.sessions_db_seconds, self.sessions):.1f}ms "
+            f"max={self.max_session_db_seconds * 1000:.1f}ms\n"
+            f"pool checkout avg={avg(self.checkouts_seconds, self.sessions):.1f}ms "
+            f"max={self.max_checkout_seconds * 1000:.1f}ms\n"
+            f"commits={self.commits} "
+            f"avg={avg(self.commits_seconds, self.commits):.1f}ms "
+            f"max={self.max_commit_seconds * 1000:.1f}ms"
+        )
+
+
+DB_STATS = DBStats()
+
+# One engine (and connection pool) per DB URI
+_engines: Dict[str, Engine] = {}
+_engines_lock = threading.Lock()
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    if settings.DB_SQLITE_WAL:
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={settings.DB_SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings.DB_SQLITE_BUSY_TIMEOUT * 1000)}")
+    cursor.close()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_start"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop("query_start", None)
+    if start is not None:
+        DB_STATS.record_query(time.perf_counter() - start, statement)
+
+
+def _create_engine(db_uri: str) -> Engine:
+    url = make_url(db_uri)
+    kwargs = dict(pool_pre_ping=settings.DB_POOL_PRE_PING)
+    connect_args = {}
+    backend = url.get_backend_name()
+    is_file_sqlite = backend == "sqlite" and url.database not in (None, "", ":memory:")
+    if backend != "sqlite" or is_file_sqlite:
+        kwargs.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+        )
+    if is_file_sqlite:
+        # connections are shared between handler threads via the pool
+        kwargs["poolclass"] = QueuePool
+        connect_args["check_same_thread"] = False
+    if backend == "postgresql" and settings.DB_STATEMENT_TIMEOUT:
+        connect_args[
+            "options"
+        ] = f"-c statement_timeout={int(settings.DB_STATEMENT_TIMEOUT * 1000)}"
+
+    engine = create_engine(db_uri, connect_args=connect_args, **kwargs)
+    if backend == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    return engine
+
+
+def get_engine(db_uri: Optional[str] = None) -> Engine:
+    db_uri = db_uri or settings.DB_URI
+    with _engines_lock:
+        engine = _engines.get(db_uri)
+        if engine is None:
+            engine = _engines[db_uri] = _create_engine(db_uri)
+        return engine
+
+
 def create_all_tables(db_uri: Optional[str] = None) -> None:
-    engine = create_engine(db_uri or settings.DB_URI)
+    Base.metadata.create_all(get_engine(db_uri))
+
+
+def migrate_tables(db_uri: Optional[str] = None) -> List[str]:
+    """Create missing tables and add missing columns to existing ones.
+
+    Safe to run repeatedly. Existing rows get column's default value, if it has one.
+    Return names of added columns.
+    """
+    engine = get_engine(db_uri)
     Base.metadata.create_all(engine)
+    existing_columns = {
+        table.name: {c["name"] for c in inspect(engine).get_columns(table.name)}
+        for table in Base.metadata.sorted_tables
+    }
+    quote = engine.dialect.identifier_preparer.quote
+    added = []
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for column in table.columns:
+                if column.name in existing_columns[table.name]:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {quote(table.name)} "
+                        f"ADD COLUMN {quote(column.name)} {column_type}"
+                    )
+                )
+                if column.default is not None and column.default.is_scalar:
+                    connection.execute(
+                        table.update().values({column.name: column.default.arg})
+                    )
+                added.append(f"{table.name}.{column.name}")
+                logger.info(f"Added column {table.name}.{column.name}")
+    return added
 
 
 def init_sessionmaker(db_uri: Optional[str] = None) -> sessionmaker:
-    engine = create_engine(db_uri or settings.DB_URI)
-    return sessionmaker(bind=engine)
+    return sessionmaker(bind=get_engine(db_uri))
 
 
 def make_session(db_uri: Optional[str] = None) -> Session:
-    engine = create_engine(db_uri or settings.DB_URI)
-    return sessionmaker(bind=engine)()
+    return sessionmaker(bind=get_engine(db_uri))()
 
 
 class ReceiverGroup(Base):
     __tablename__ = "receivergroup"
 
+    class DeliveryMode:
+        FORWARD = "forward"
+        DIGEST = "digest"
+
+        ALL = frozenset({FORWARD, DIGEST})
+
     class Default:
         ENABLED = False
+        DELIVERY_MODE = "forward"
+
+    RULE_MAX_LENGTH = 1024
 
     id = Column(Integer, primary_key=True)
     chat_id = Column(BigInteger, unique=True)
     enabled = Column(Boolean, default=Default.ENABLED)
     title = Column(String(length=255), nullable=True)
     tags = Column(JSON, default=[])
+    delivery_mode = Column(String(length=16), default=Default.DELIVERY_MODE)
+    # normalized custom subscription rule, derived from tags when not set
+    rule = Column(String(length=RULE_MAX_LENGTH), nullable=True)
+    # last /disable, posts older than that were delivered before
+    disabled_at = Column(DateTime, nullable=True)
 
     @property
     def is_enabled(self) -> bool:
@@ -58,6 +277,20 @@ class ReceiverGroup(Base):
     def tags_set(self) -> Set[str]:
         return set(t.lower() for t in self.tags)
 
+    @property
+    def rule_expression(self) -> str:
+        if self.rule is not None:
+            return self.rule
+        return rules.tags_to_expression(
+            frozenset(self.tags_set),
+            extending_tags=settings.POST_EXTENDING_TAGS,
+            restrictive_tags=settings.POST_RESTRICTIVE_TAGS,
+        )
+
+    @property
+    def is_digest(self) -> bool:
+        return self.delivery_mode == self.DeliveryMode.DIGEST
+
     @classmethod
     def get_by_chat_id(
         cls, chat_id: int, *, session: Session
@@ -81,6 +314,10 @@ class ReceiverGroup(Base):
         session.add(new_obj)
         return new_obj
 
+    @classmethod
+    def list_enabled(cls, *, session: Session) -> ["ReceiverGroup", ...]:
+        return list(session.query(cls).filter(cls.enabled == True))
+
     @classmethod
     def list_enabled_chat_ids(cls, *, session: Session) -> [int, ...]:
         query = session.query(cls.chat_id).filter(cls.enabled == True)
@@ -91,6 +328,7 @@ class ReceiverGroup(Base):
 
     def disable(self):
         self.enabled = False
+        self.disabled_at = datetime.datetime.utcnow()
 
     def update_title(self, title: str) -> bool:
         if title != self.title:
@@ -100,6 +338,16 @@ class ReceiverGroup(Base):
         # if passed old value - do nothing
         return False
 
+    def set_delivery_mode(self, delivery_mode: str) -> bool:
+        if delivery_mode not in self.DeliveryMode.ALL:
+            raise ValueError(f"Unknown delivery mode: {delivery_mode}")
+        if delivery_mode != (self.delivery_mode or self.Default.DELIVERY_MODE):
+            self.delivery_mode = delivery_mode
+            logger.info(f"Changing delivery mode of chatID={self.chat_id}")
+            return True
+        # if passed old value - do nothing
+        return False
+
     def set_tags(self, tags: Iterable[str]) -> bool:
         if set(tags) != self.tags_set:
             sortable = list(tags)
@@ -113,6 +361,26 @@ class ReceiverGroup(Base):
         # if passed old value - do nothing
         return False
 
+    @property
+    def has_custom_rule(self) -> bool:
+        return self.rule is not None
+
+    def set_rule(self, expression: str) -> bool:
+        """Set custom subscription rule, raise rules.RuleError if it is invalid.
+
+        Empty expression removes custom rule, so subscription follows tags again.
+        Tags are replaced with the tags the rule subscribes to (not negated ones).
+        """
+        normalized = rules.normalize(expression) or None
+        if normalized != self.rule:
+            self.rule = normalized
+            if normalized is not None:
+                self.tags = sorted(rules.positive_tags(normalized))
+            logger.info(f"Changing subscription rule of chatID={self.chat_id}")
+            return True
+        # if passed old value - do nothing
+        return False
+
     def add_tags(self, tags: Iterable[str]) -> bool:
         change_to = self.tags_set.union(set(tags))
         return self.set_tags(tags=change_to)
@@ -138,6 +406,8 @@ class ReceiverGroup(Base):
             "enabled": self.enabled,
             "title": self.title,
             "tags": list(self.tags),
+            "delivery_mode": self.delivery_mode or self.Default.DELIVERY_MODE,
+            "rule": self.rule,
         }
         return d
 
@@ -148,6 +418,8 @@ class ReceiverGroup(Base):
             enabled=d.get("enabled", False),
             title=d.get("title", None),
             tags=d.get("tags", []),
+            delivery_mode=d.get("delivery_mode", cls.Default.DELIVERY_MODE),
+            rule=d.get("rule", None),
         )
         if session:
             session.add(obj)
@@ -162,3 +434,240 @@ class ReceiverGroup(Base):
         cls, serializable: [dict, ...], *, session: Optional[Session]
     ) -> ["ReceiverGroup", ...]:
         return [cls.from_dict(obj_dict, session=session) for obj_dict in serializable]
+
+
+class SourcePost(Base):
+    """Recent post from the source channel, kept for backfill."""
+
+    __tablename__ = "sourcepost"
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(BigInteger, unique=True)
+    tags = Column(JSON, default=[])
+    link = Column(String(length=255), nullable=True)
+    # hash of post content, to tell real edits from no-op ones
+    content_hash = Column(String(length=64), nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+    @property
+    def tags_set(self) -> FrozenSet[str]:
+        return frozenset(t.lower() for t in self.tags)
+
+    @classmethod
+    def get_by_message_id(
+        cls, message_id: int, *, session: Session
+    ) -> "SourcePost" or None:
+        return session.query(cls).filter(cls.message_id == message_id).first()
+
+    @classmethod
+    def record(
+        cls,
+        message_id: int,
+        tags: Iterable[str],
+        link: Optional[str] = None,
+        content_hash: Optional[str] = None,
+        *,
+        session: Session,
+    ) -> "SourcePost":
+        obj = cls.get_by_message_id(message_id, session=session)
+        if obj is None:
+            obj = cls(message_id=message_id)
+        obj.tags = sorted(tags)
+        obj.link = link
+        obj.content_hash = content_hash
+        session.add(obj)
+        return obj
+
+    @classmethod
+    def list_since(
+        cls, since: datetime.datetime, *, session: Session
+    ) -> ["SourcePost", ...]:
+        query = (
+            session.query(cls).filter(cls.created_at >= since).order_by(cls.message_id)
+        )
+        return list(query)
+
+    @classmethod
+    def prune(cls, before: datetime.datetime, *, session: Session) -> int:
+        return (
+            session.query(cls)
+            .filter(cls.created_at < before)
+            .delete(synchronize_session=False)
+        )
+
+    @classmethod
+    def delete_by_message_id(cls, message_id: int, *, session: Session) -> int:
+        return (
+            session.query(cls)
+            .filter(cls.message_id == message_id)
+            .delete(synchronize_session=False)
+        )
+
+    def __repr__(self) -> str:
+        return f"<SourcePost message_id={self.message_id} tags={self.tags}>"
+
+
+class DigestEntry(Base):
+    """Post queued for the next digest of a receiver group."""
+
+    __tablename__ = "digestentry"
+
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger, index=True)
+    message_id = Column(BigInteger)
+    link = Column(String(length=255), nullable=True)
+    tags = Column(JSON, default=[])
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # failed delivery attempts, entry is dropped after DIGEST_MAX_ATTEMPTS
+    attempts = Column(Integer, default=0)
+
+    @classmethod
+    def add(
+        cls,
+        chat_id: int,
+        message_id: int,
+        link: Optional[str],
+        tags: Iterable[str],
+        *,
+        session: Session,
+    ) -> "DigestEntry":
+        obj = cls(chat_id=chat_id, message_id=message_id, link=link, tags=sorted(tags))
+        session.add(obj)
+        return obj
+
+    @classmethod
+    def list_due_chat_ids(
+        cls, older_than: datetime.datetime, limit: int, *, session: Session
+    ) -> [int, ...]:
+        """Enabled chats with entries older than ``older_than``, oldest first."""
+        oldest = func.min(cls.created_at)
+        enabled_chat_ids = session.query(ReceiverGroup.chat_id).filter(
+            ReceiverGroup.enabled == True
+        )
+        query = (
+            session.query(cls.chat_id)
+            .filter(cls.chat_id.in_(enabled_chat_ids))
+            .group_by(cls.chat_id)
+            .having(oldest <= older_than)
+            .order_by(oldest)
+            .limit(limit)
+        )
+        return [chat_id for chat_id, in query]
+
+    @classmethod
+    def list_for_chat(cls, chat_id: int, *, session: Session) -> ["DigestEntry", ...]:
+        query = (
+            session.query(cls).filter(cls.chat_id == chat_id).order_by(cls.message_id)
+        )
+        return list(query)
+
+    @classmethod
+    def delete_for_chat(cls, chat_id: int, *, session: Session) -> int:
+        return (
+            session.query(cls)
+            .filter(cls.chat_id == chat_id)
+            .delete(synchronize_session=False)
+        )
+
+    @classmethod
+    def delete_by_ids(cls, ids: Iterable[int], *, session: Session) -> int:
+        ids = list(ids)
+        if not ids:
+            return 0
+        return (
+            session.query(cls).filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        )
+
+    @classmethod
+    def record_failed_attempt(
+        cls, ids: Iterable[int], max_attempts: int, *, session: Session
+    ) -> int:
+        """Count failed attempt for entries, drop those out of attempts.
+
+        Return number of dropped entries.
+        """
+        ids = list(ids)
+        if not ids:
+            return 0
+        query = session.query(cls).filter(cls.id.in_(ids))
+        query.update(
+            {cls.attempts: func.coalesce(cls.attempts, 0) + 1},
+            synchronize_session=False,
+        )
+        return query.filter(cls.attempts >= max_attempts).delete(
+            synchronize_session=False
+        )
+
+    @classmethod
+    def delete_by_message_id(
+        cls,
+        message_id: int,
+        chat_ids: Optional[Iterable[int]] = None,
+        *,
+        session: Session,
+    ) -> int:
+        """Delete pending entries of the post, only in given chats if passed."""
+        query = session.query(cls).filter(cls.message_id == message_id)
+        if chat_ids is not None:
+            chat_ids = list(chat_ids)
+            if not chat_ids:
+                return 0
+            query = query.filter(cls.chat_id.in_(chat_ids))
+        return query.delete(synchronize_session=False)
+
+    def __repr__(self) -> str:
+        return f"<DigestEntry chat_id={self.chat_id} message_id={self.message_id}>"
+
+
+class DeliveredCopy(Base):
+    """Copy of a source post delivered to a receiver group."""
+
+    __tablename__ = "deliveredcopy"
+
+    id = Column(Integer, primary_key=True)
+    source_message_id = Column(BigInteger, index=True)
+    chat_id = Column(BigInteger)
+    message_id = Column(BigInteger)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+    @classmethod
+    def record(
+        cls, source_message_id: int, chat_id: int, message_id: int, *, session: Session
+    ) -> "DeliveredCopy":
+        obj = cls(
+            source_message_id=source_message_id,
+            chat_id=chat_id,
+            message_id=message_id,
+        )
+        session.add(obj)
+        return obj
+
+    @classmethod
+    def list_for_source(
+        cls, source_message_id: int, *, session: Session
+    ) -> ["DeliveredCopy", ...]:
+        query = session.query(cls).filter(cls.source_message_id == source_message_id)
+        return list(query)
+
+    @classmethod
+    def delete_by_ids(cls, ids: Iterable[int], *, session: Session) -> int:
+        ids = list(ids)
+        if not ids:
+            return 0
+        return (
+            session.query(cls).filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        )
+
+    @classmethod
+    def prune(cls, before: datetime.datetime, *, session: Session) -> int:
+        return (
+            session.query(cls)
+            .filter(cls.created_at < before)
+            .delete(synchronize_session=False)
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"<DeliveredCopy source_message_id={self.source_message_id} "
+            f"chat_id={self.chat_id} message_id={self.message_id}>"
+        )
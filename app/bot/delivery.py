@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Optional, Set, Tuple
+
+
+class RateBudget:
+    """Sliding one-second window of Bot API calls shared by all senders.
+
+    Live broadcasts always proceed and only record their calls.
+    Background jobs (e.g. backfill) may send only while no live broadcast
+    is running and only within their share of the rate limit.
+    """
+
+    WINDOW = 1.0
+
+    def __init__(self, rate_limit: float, background_share: float):
+        self.rate_limit = rate_limit
+        self.background_share = background_share
+        self._calls: Deque[float] = deque()
+        self._live_broadcasts = 0
+        self._lock = threading.Lock()
+
+    def _forget_old_calls(self, now: float) -> None:
+        while self._calls and now - self._calls[0] > self.WINDOW:
+            self._calls.popleft()
+
+    @contextmanager
+    def live(self):
+        """Mark a live broadcast as running for the duration of the block."""
+        with self._lock:
+            self._live_broadcasts += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._live_broadcasts -= 1
+
+    @property
+    def is_live(self) -> bool:
+        return self._live_broadcasts > 0
+
+    def record(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._forget_old_calls(now)
+            self._calls.append(now)
+
+    def spare(self) -> int:
+        """Number of calls background jobs may make right now."""
+        now = time.monotonic()
+        with self._lock:
+            if self._live_broadcasts:
+                return 0
+            self._forget_old_calls(now)
+            allowed = int(self.rate_limit * self.background_share)
+            return max(allowed - len(self._calls), 0)
+
+    def try_acquire_background(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if self._live_broadcasts:
+                return False
+            self._forget_old_calls(now)
+            allowed = int(self.rate_limit * self.background_share)
+            if len(self._calls) >= allowed:
+                return False
+            self._calls.append(now)
+            return True
+
+
+class DeliveryQueue:
+    """FIFO of (chat_id, message_id) pairs without duplicates."""
+
+    def __init__(self):
+        self._items: Deque[Tuple[int, int]] = deque()
+        self._pending: Set[Tuple[int, int]] = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, chat_id: int, message_id: int) -> bool:
+        item = (chat_id, message_id)
+        with self._lock:
+            if item in self._pending:
+                return False
+            self._pending.add(item)
+            self._items.append(item)
+            return True
+
+    def get(self) -> Optional[Tuple[int, int]]:
+        with self._lock:
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._pending.discard(item)
+            return item
+
+    def _discard(self, predicate) -> int:
+        with self._lock:
+            kept = deque(item for item in self._items if not predicate(item))
+            dropped = len(self._items) - len(kept)
+            self._items = kept
+            self._pending = set(kept)
+            return dropped
+
+    def discard_chat(self, chat_id: int) -> int:
+        """Drop all pending items for given chat, return number of dropped items."""
+        return self._discard(lambda item: item[0] == chat_id)
+
+    def discard_message(self, message_id: int) -> int:
+        """Drop all pending items for given message, return number of dropped items."""
+        return self._discard(lambda item: item[1] == message_id)
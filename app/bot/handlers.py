@@ -1,14 +1,23 @@
+import datetime
+import hashlib
 import logging
 import time
 from contextlib import contextmanager
-from typing import Set, Iterable
+from typing import Set, Iterable, Optional
 
 import telegram
 from telegram import Update, Message
 from telegram.ext import CallbackContext
 
-from . import settings, storage
-from .dbadapter import ReceiverGroup
+from . import route, rules, settings, storage, transport
+from .dbadapter import (
+    DB_STATS,
+    ReceiverGroup,
+    SourcePost,
+    DigestEntry,
+    DeliveredCopy,
+    Session,
+)
 
 # TODO: Use latest python-telegram-bot version; Use async syntax
 # TODO: command to send post with specific tags ?
@@ -32,7 +41,10 @@ Other commands:
 /enable - enable broadcasting to this chat (disabled by default)
 /disable - disable broadcasting to this chat
 /status - display group chat status
-/tags - modify tag subscriptions
+/tags - modify tag subscriptions or set subscription rule
+/delivery - choose between forwarding each post and periodic digests
+/retract - (private chat) delete all delivered copies of a source post
+/route - (private chat) dry-run routing of sample post text or tags
 /help - display this message
 """
 
@@ -40,16 +52,41 @@ Other commands:
 @contextmanager
 def db_session_from_context(context: CallbackContext):
     """Provide a transactional scope around a series of operations."""
+    start = time.perf_counter()
+    query_seconds = DB_STATS.thread_query_seconds()
+    checkout_seconds = 0.0
+    commit_seconds = None
     session = storage.BotData.get_db_session_maker(context.bot_data)()
     try:
+        # check out pooled connection upfront to measure waiting for it
+        checkout_start = time.perf_counter()
+        session.connection()
+        checkout_seconds = time.perf_counter() - checkout_start
         yield session
+        commit_start = time.perf_counter()
+        flush_start = DB_STATS.thread_query_seconds()
         session.commit()
+        # statements flushed on commit are already counted as queries
+        commit_seconds = (time.perf_counter() - commit_start) - (
+            DB_STATS.thread_query_seconds() - flush_start
+        )
     except Exception as exc:
         logger.exception(f"Unexpected error in attempt to commit session: ")
         session.rollback()
         raise
     finally:
         session.close()
+        DB_STATS.record_session(
+            time.perf_counter() - start,
+            query_seconds=DB_STATS.thread_query_seconds() - query_seconds,
+            checkout_seconds=checkout_seconds,
+            commit_seconds=commit_seconds,
+        )
+
+
+def _delivery_bot(context: CallbackContext) -> telegram.Bot:
+    """Bot with its own connection pool for delivery to receiver groups."""
+    return storage.BotData.get_delivery_bot(context.bot_data)
 
 
 # Bot commands
@@ -116,6 +153,16 @@ def command_debug(update: Update, context: CallbackContext) -> None:
             else:
                 reply_md += f"No data for this group chat."
 
+    # Bot API transport stats
+    reply_md += "\nTransport:\n```\n"
+    for request in (context.bot.request, _delivery_bot(context).request):
+        if isinstance(request, transport.TimedRequest):
+            reply_md += transport.format_stats(request.stats()) + "\n"
+    reply_md += "```\n"
+
+    # DB stats
+    reply_md += f"\nDB:\n```\n{DB_STATS}\n```"
+
     update.message.reply_markdown(reply_md)
 
 
@@ -146,15 +193,18 @@ def command_status(update: Update, context: CallbackContext) -> None:
                 )
 
             # Tag subscriptions
-            if rg.tags:
-                reply_md += (
-                    f"\nSubscribed to tags: "
-                    + " ".join(f"#{t}" for t in rg.tags)
-                    + "\n"
-                )
+            if rg.rule_expression:
+                reply_md += f"\nSubscription rule: `{rg.rule_expression}`\n"
             else:
-                reply_md += "\nNo active subscriptions."
-            reply_md += "Use command /tags to manage tag subscriptions."
+                reply_md += "\nNo active subscriptions.\n"
+            reply_md += "Use command /tags to manage tag subscriptions.\n"
+
+            # Delivery mode
+            if rg.is_digest:
+                reply_md += "\nPosts are delivered as periodic digests.\n"
+            else:
+                reply_md += "\nPosts are forwarded one by one.\n"
+            reply_md += "Use command /delivery to change delivery mode."
 
             # update chat data
             if rg.update_title(title=chat.title):
@@ -183,6 +233,9 @@ def command_enable(update: Update, context: CallbackContext) -> None:
                 rg.enable()
                 db_session.add(rg)
                 reply_msg = "Broadcasting to this group chat successfully enabled."
+                _enqueue_backfill(
+                    rg, previous_rule=None, db_session=db_session, context=context
+                )
 
             # update chat data
             if rg.update_title(title=chat.title):
@@ -211,6 +264,10 @@ def command_disable(update: Update, context: CallbackContext) -> None:
                 rg.disable()
                 db_session.add(rg)
                 reply_msg = "Broadcasting to this group chat successfully disabled."
+                storage.BotData.get_backfill_queue(context.bot_data).discard_chat(
+                    rg.chat_id
+                )
+                DigestEntry.delete_for_chat(rg.chat_id, session=db_session)
 
             # update chat data
             if rg.update_title(title=chat.title):
@@ -236,7 +293,49 @@ def command_tags(update: Update, context: CallbackContext) -> None:
             return
 
         followup_reply_md = ""
-        if context.args:
+        previous_rule = rg.rule_expression
+        if context.args and not all(a[:1] in {"+", "-"} for a in context.args):
+            # subscription rule, e.g. `/tags (python | go) & remote & !intern`
+            expression = " ".join(context.args).lstrip("=")
+            try:
+                normalized = rules.normalize(expression)
+                not_allowed_tags = rules.referenced_tags(expression).difference(
+                    settings.ALL_TAGS
+                )
+            except rules.RuleError as exc:
+                reply_md = f"Invalid subscription rule: `{exc}`"
+            else:
+                if not_allowed_tags:
+                    reply_md = "These tags where provided, but are not allowed:\n"
+                    reply_md += "`" + " ".join(f"{t}" for t in not_allowed_tags) + "`"
+                elif len(normalized) > ReceiverGroup.RULE_MAX_LENGTH:
+                    reply_md = (
+                        f"Subscription rule is too long: {len(normalized)} characters, "
+                        f"at most {ReceiverGroup.RULE_MAX_LENGTH} allowed."
+                    )
+                elif rg.set_rule(expression):
+                    db_session.add(rg)
+                    if rg.is_enabled:
+                        _enqueue_backfill(
+                            rg,
+                            previous_rule=previous_rule,
+                            db_session=db_session,
+                            context=context,
+                        )
+                    if rg.has_custom_rule:
+                        reply_md = f"Updated subscription rule to:\n`{rg.rule}`"
+                    else:
+                        reply_md = "Removed custom subscription rule, following tags:\n"
+                        reply_md += f"`{rg.rule_expression or '<none>'}`"
+                else:
+                    reply_md = "No changes detected."
+        elif context.args and rg.has_custom_rule:
+            reply_md = f"This group chat has custom subscription rule:\n`{rg.rule}`\n"
+            reply_md += (
+                "Set a new rule with `/tags <rule>`, "
+                + "or remove it with `/tags =` to manage tags with `+`/`-` again."
+            )
+        elif context.args:
             tags_to_add = set(t[1:] for t in context.args if t.startswith("+"))
             not_allowed_tags = tags_to_add.difference(settings.ALL_TAGS)
             tags_to_remove = set(t[1:] for t in context.args if t.startswith("-"))
@@ -247,10 +346,18 @@ def command_tags(update: Update, context: CallbackContext) -> None:
             )
             if tags_changed:
                 db_session.add(rg)
+                if rg.is_enabled:
+                    _enqueue_backfill(
+                        rg,
+                        previous_rule=previous_rule,
+                        db_session=db_session,
+                        context=context,
+                    )
                 reply_md = "Updated subscription tags to:\n"
                 reply_md += (
                     "\n".join(f"{i + 1}) `{t}`" for i, t in enumerate(rg.tags)) + "\n"
                 )
+                reply_md += f"Subscription rule: `{rg.rule_expression or '<none>'}`\n"
                 if not_allowed_tags:
                     reply_md += "These tags where provided, but are not allowed:\n"
                     reply_md += "`" + " ".join(f"{t}" for t in not_allowed_tags) + "`"
@@ -259,18 +366,29 @@ def command_tags(update: Update, context: CallbackContext) -> None:
             else:
                 reply_md = "No changes detected."
         else:
-            if rg.tags:
+            if rg.has_custom_rule:
+                reply_md = f"Custom subscription rule:\n`{rg.rule}`\n"
+            elif rg.tags:
                 reply_md = f"Active subscription tags:\n"
                 reply_md += (
                     "\n".join(f"{i + 1}) `{t}`" for i, t in enumerate(rg.tags)) + "\n"
                 )
             else:
                 reply_md = "No active subscription tags.\n"
+            if not rg.has_custom_rule and rg.rule_expression:
+                reply_md += f"Subscription rule: `{rg.rule_expression}`\n"
             reply_md += "\n"
+            if not rg.has_custom_rule:
+                reply_md += (
+                    "To change subscription tags, pass them to this "
+                    + "command in the following format: `/tags +TagIWantToAdd -TagIWantToRemove`\n"
+                )
             reply_md += (
-                "To change subscription tags, pass them to this "
-                + "command in the following format: `/tags +TagIWantToAdd -TagIWantToRemove`\n"
+                "To set custom subscription rule, pass an expression with `&` (and), "
+                + "`|` (or), `!` (not) and parentheses: `/tags (python | go) & remote & !intern`\n"
             )
+            if rg.has_custom_rule:
+                reply_md += "To remove custom rule and follow tags again: `/tags =`\n"
             reply_md += "\n"
 
             if rg.tags:
@@ -290,36 +408,100 @@ def command_tags(update: Update, context: CallbackContext) -> None:
         reply.reply_markdown(followup_reply_md)
 
 
-def _forward_post(
-    receiver_group: ReceiverGroup, *, update: Update, context: CallbackContext
-):
-    source_chat = update.effective_chat
-    post = update.effective_message
+def command_delivery(update: Update, context: CallbackContext) -> None:
+    """Manage group chat delivery mode."""
+    logger.debug(f"Command /delivery from {update.effective_chat.id} chat.")
+    chat = update.effective_chat
+
+    with db_session_from_context(context) as db_session:
+        rg = ReceiverGroup.get_by_chat_id(
+            chat_id=chat.id,
+            session=db_session,
+        )
+        rg: ReceiverGroup
+        if not rg:
+            reply_msg = "Use command /start first."
+            update.effective_message.reply_text(reply_msg)
+            return
+
+        current_mode = rg.delivery_mode or ReceiverGroup.Default.DELIVERY_MODE
+        if context.args:
+            delivery_mode = context.args[0].lower()
+            if delivery_mode not in ReceiverGroup.DeliveryMode.ALL:
+                reply_md = f"Unknown delivery mode `{delivery_mode}`.\n"
+            elif rg.set_delivery_mode(delivery_mode):
+                db_session.add(rg)
+                reply_md = f"Updated delivery mode to `{delivery_mode}`.\n"
+            else:
+                reply_md = "No changes detected.\n"
+        else:
+            reply_md = f"Active delivery mode: `{current_mode}`\n"
+        reply_md += (
+            "\n"
+            "To change delivery mode, pass it to this command: "
+            "`/delivery forward` to forward each post, "
+            f"`/delivery digest` to receive one digest every "
+            f"{settings.DIGEST_INTERVAL_MINUTES:g} minutes.\n"
+        )
+
+        # update chat data
+        if rg.update_title(title=chat.title):
+            db_session.add(rg)
+
+    update.effective_message.reply_markdown(reply_md)
+
+
+def _forward_message(
+    bot: telegram.Bot, *, chat_id: int, from_chat_id: int, message_id: int
+) -> Optional[Message]:
     logger.debug(
-        f"Preparing to forward message {source_chat.id}/{post.message_id} "
-        f'to chat {receiver_group.chat_id} "{receiver_group.title}"'
+        f"Preparing to forward message {from_chat_id}/{message_id} to chat {chat_id}"
     )
     try:
-        context.bot.forward_message(
-            chat_id=receiver_group.chat_id,
-            from_chat_id=source_chat.id,
-            message_id=post.message_id,
+        return bot.forward_message(
+            chat_id=chat_id,
+            from_chat_id=from_chat_id,
+            message_id=message_id,
         )
     except telegram.error.BadRequest as bad_request:
         logger.warning(
-            f"Attempt to forward message to chat {receiver_group.chat_id} failed due to "
+            f"Attempt to forward message to chat {chat_id} failed due to "
             f"BadRequest error: {bad_request}"
         )
     except telegram.error.ChatMigrated as e:
-        logger.error(
-            f"Chat {receiver_group.title} with tags {receiver_group.tags} got migrated: {e}"
-        )
+        logger.error(f"Chat {chat_id} got migrated: {e}")
     except Exception as exc:
         logger.exception(f"Unhandled error during attempt ot forward message: {exc}")
-    else:
-        logger.info(
-            f'Successfully forwarded post {post.link} to chat "{receiver_group.title}"'
+    return None
+
+
+def _delete_message(bot: telegram.Bot, *, chat_id: int, message_id: int) -> bool:
+    try:
+        return bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except telegram.error.BadRequest as bad_request:
+        logger.warning(
+            f"Attempt to delete message {message_id} in chat {chat_id} failed due to "
+            f"BadRequest error: {bad_request}"
         )
+    except Exception as exc:
+        logger.exception(f"Unhandled error during attempt to delete message: {exc}")
+    return False
+
+
+def _forward_post(
+    chat_id: int, title: str, *, update: Update, context: CallbackContext
+) -> Optional[Message]:
+    source_chat = update.effective_chat
+    post = update.effective_message
+    forwarded = _forward_message(
+        _delivery_bot(context),
+        chat_id=chat_id,
+        from_chat_id=source_chat.id,
+        message_id=post.message_id,
+    )
+    if forwarded is not None:
+        logger.info(f'Successfully forwarded post {post.link} to chat "{title}"')
+    return forwarded
 
 
 def _extract_hashtags(message: Message, allowed_hashtags: Set[str]) -> Iterable[str]:
@@ -350,6 +532,200 @@ def _extract_hashtags(message: Message, allowed_hashtags: Set[str]) -> Iterable[
         yield hashtag
 
 
+def _content_hash(message: Message) -> str:
+    """Hash of post text, caption and attached media, to detect no-op edits."""
+    attachment = message.effective_attachment
+    if isinstance(attachment, list):
+        # photo sizes of the same photo
+        attachment = attachment[-1] if attachment else None
+    parts = (
+        message.text or "",
+        message.caption or "",
+        getattr(attachment, "file_unique_id", None) or "",
+    )
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def _enqueue_backfill(
+    receiver_group: ReceiverGroup,
+    *,
+    previous_rule: Optional[str],
+    db_session: Session,
+    context: CallbackContext,
+) -> int:
+    """Queue recent posts which given group missed.
+
+    Pass ``previous_rule=None`` when group was disabled before, then only posts
+    published since it was disabled are queued, otherwise only posts not matching
+    previous rule are queued.
+    """
+    if not settings.BACKFILL:
+        return 0
+    since = datetime.datetime.utcnow() - datetime.timedelta(
+        hours=settings.BACKFILL_WINDOW_HOURS
+    )
+    if previous_rule is None and receiver_group.disabled_at is not None:
+        since = max(since, receiver_group.disabled_at)
+    queue = storage.BotData.get_backfill_queue(context.bot_data)
+    is_receiver = rules.compile_rule(receiver_group.rule_expression)
+    was_receiver = rules.compile_rule(previous_rule or "")
+    queued = 0
+    for source_post in SourcePost.list_since(since, session=db_session):
+        post_tags = source_post.tags_set
+        if not is_receiver(post_tags) or was_receiver(post_tags):
+            continue
+        if receiver_group.is_digest:
+            DigestEntry.add(
+                chat_id=receiver_group.chat_id,
+                message_id=source_post.message_id,
+                link=source_post.link,
+                tags=source_post.tags,
+                session=db_session,
+            )
+            queued += 1
+        elif queue.put(receiver_group.chat_id, source_post.message_id):
+            queued += 1
+    logger.info(
+        f"Queued {queued} missed post(s) for backfill to chat {receiver_group.chat_id}"
+    )
+    return queued
+
+
+def job_backfill(context: CallbackContext) -> None:
+    """Forward queued missed posts using only spare rate limit budget."""
+    queue = storage.BotData.get_backfill_queue(context.bot_data)
+    budget = storage.BotData.get_rate_budget(context.bot_data)
+    copies = []
+    while len(queue) and budget.try_acquire_background():
+        item = queue.get()
+        if item is None:
+            break
+        chat_id, message_id = item
+        forwarded = _forward_message(
+            _delivery_bot(context),
+            chat_id=chat_id,
+            from_chat_id=settings.SOURCE_CHANNEL,
+            message_id=message_id,
+        )
+        if forwarded is not None:
+            logger.info(f"Backfilled post #{message_id} to chat {chat_id}")
+            copies.append((message_id, chat_id, forwarded.message_id))
+
+    if copies:
+        with db_session_from_context(context) as db_session:
+            for source_message_id, chat_id, message_id in copies:
+                DeliveredCopy.record(
+                    source_message_id=source_message_id,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    session=db_session,
+                )
+
+
+def _format_digest(entries: ["DigestEntry", ...]) -> [(str, [int, ...]), ...]:
+    """Split digest into messages, each paired with IDs of entries it lists."""
+    messages = []
+    text, entry_ids = f"Digest: {len(entries)} new post(s)", []
+    for i, entry in enumerate(entries):
+        tags = " ".join(f"#{t}" for t in entry.tags)
+        line = f"{i + 1}) {entry.link or f'post #{entry.message_id}'} {tags}"
+        # Telegram limits message to 4096 unicode code points,
+        # split only after the message lists at least one entry
+        if entry_ids and len(text) + 1 + len(line) > 4096:
+            messages.append((text, entry_ids))
+            text, entry_ids = line, []
+        else:
+            text += "\n" + line
+        text = text[:4096]
+        entry_ids.append(entry.id)
+    messages.append((text, entry_ids))
+    return messages
+
+
+def job_flush_digests(context: CallbackContext) -> None:
+    """Send digests to a batch of receiver groups whose interval elapsed."""
+    budget = storage.BotData.get_rate_budget(context.bot_data)
+    older_than = datetime.datetime.utcnow() - datetime.timedelta(
+        minutes=settings.DIGEST_INTERVAL_MINUTES
+    )
+    with db_session_from_context(context) as db_session:
+        chat_ids = DigestEntry.list_due_chat_ids(
+            older_than=older_than,
+            limit=settings.DIGEST_BATCH_SIZE,
+            session=db_session,
+        )
+        digests = {
+            chat_id: _format_digest(
+                DigestEntry.list_for_chat(chat_id, session=db_session)
+            )
+            for chat_id in chat_ids
+        }
+
+    # only entries listed in delivered messages are removed,
+    # entries added meanwhile wait for the next digest
+    sent_entry_ids = []
+    dropped_entry_ids = []
+    failed_entry_ids = []
+    out_of_budget = False
+    for chat_id, messages in digests.items():
+        chat_entry_ids = [i for _, entry_ids in messages for i in entry_ids]
+        sent = 0
+        try:
+            for text, entry_ids in messages:
+                # stay within background share, leave the rest for the next run
+                # (e.g. while live broadcast is going on)
+                if not budget.try_acquire_background():
+                    out_of_budget = True
+                    break
+                _delivery_bot(context).send_message(
+                    chat_id=chat_id,
+                    text=text,
+                    disable_web_page_preview=True,
+                )
+                sent_entry_ids.extend(entry_ids)
+                sent += len(entry_ids)
+        except telegram.error.RetryAfter as exc:
+            # flood control is not a failure of this chat, keep its entries as is
+            logger.warning(
+                f"Attempt to send digest to chat {chat_id} hit flood control, "
+                f"retry after {exc.retry_after}s. Leaving digests for the next run."
+            )
+            out_of_budget = True
+        except (
+            telegram.error.BadRequest,
+            telegram.error.Unauthorized,
+            telegram.error.ChatMigrated,
+        ) as exc:
+            # chat is gone or bot can not post there, retrying won't help
+            logger.warning(
+                f"Attempt to send digest to chat {chat_id} failed due to "
+                f"{exc.__class__.__name__} error: {exc}. Dropping pending digest."
+            )
+            dropped_entry_ids.extend(chat_entry_ids[sent:])
+        except Exception as exc:
+            logger.exception(f"Unhandled error during attempt to send digest: {exc}")
+            failed_entry_ids.extend(chat_entry_ids[sent:])
+        if sent:
+            logger.info(f"Sent digest of {sent} post(s) to chat {chat_id}")
+        if out_of_budget:
+            break
+
+    if sent_entry_ids or dropped_entry_ids or failed_entry_ids:
+        with db_session_from_context(context) as db_session:
+            DigestEntry.delete_by_ids(
+                sent_entry_ids + dropped_entry_ids, session=db_session
+            )
+            # transient errors are retried on next runs, but not forever,
+            # otherwise failing chats would stay first in every batch
+            exhausted = DigestEntry.record_failed_attempt(
+                failed_entry_ids,
+                max_attempts=settings.DIGEST_MAX_ATTEMPTS,
+                session=db_session,
+            )
+        if exhausted:
+            logger.warning(f"Dropped {exhausted} digest entries out of attempts")
+
+
 def handler_broadcast_post(update: Update, context: CallbackContext) -> None:
     """Broadcast post from channel to connected groups."""
     post = update.effective_message
@@ -358,52 +734,108 @@ def handler_broadcast_post(update: Update, context: CallbackContext) -> None:
     )
 
     receivers_list: list[dict[str, str | int]] = []
+    digest_receivers_list: list[dict[str, str | int]] = []
 
-    extending_tags = frozenset(
+    post_tags = frozenset(
         t.lower()
         for t in _extract_hashtags(
             message=post,
-            allowed_hashtags=settings.POST_EXTENDING_TAGS,
-        )
-    )
-    restrictive_tags = frozenset(
-        t.lower()
-        for t in _extract_hashtags(
-            message=post,
-            allowed_hashtags=settings.POST_RESTRICTIVE_TAGS,
+            allowed_hashtags=settings.ALL_TAGS,
         )
     )
+    extending_tags = post_tags & settings.POST_EXTENDING_TAGS
+    restrictive_tags = post_tags & settings.POST_RESTRICTIVE_TAGS
 
     logger.debug(
         f'Post #{post.message_id} in "{update.effective_chat.title}" tg#{update.effective_chat.id} channel '
         f'contains allowed tags: extending=[{",".join(extending_tags)}], restrictive=[{",".join(restrictive_tags)}]'
     )
 
+    # Keep write transactions short: nothing below holds a session
+    # while calling Bot API, so other handlers and jobs are not blocked
+    # by the DB write lock for the duration of the broadcast.
     with db_session_from_context(context) as db_session:
-        enabled_groups = list(
-            db_session.query(ReceiverGroup).filter(ReceiverGroup.enabled == True)
+        SourcePost.record(
+            message_id=post.message_id,
+            tags=post_tags,
+            link=post.link,
+            content_hash=_content_hash(post),
+            session=db_session,
+        )
+        SourcePost.prune(
+            before=datetime.datetime.utcnow()
+            - datetime.timedelta(hours=settings.BACKFILL_WINDOW_HOURS),
+            session=db_session,
+        )
+        DeliveredCopy.prune(
+            before=datetime.datetime.utcnow()
+            - datetime.timedelta(hours=settings.COPIES_RETENTION_HOURS),
+            session=db_session,
         )
+        enabled_chat_ids = ReceiverGroup.list_enabled_chat_ids(session=db_session)
+
+    # fetch chat titles for later use
+    actual_titles = {}
+    if settings.AUTOUPDATE_CHAT_TITLES:
+        for chat_id in enabled_chat_ids:
+            try:
+                actual_titles[chat_id] = context.bot.get_chat(chat_id).title
+            except telegram.error.TelegramError as exc:
+                # keep old title, forwarding reports if the chat is gone
+                logger.warning(f"Attempt to get title of chat {chat_id} failed: {exc}")
+
+    with db_session_from_context(context) as db_session:
+        enabled_groups = ReceiverGroup.list_enabled(session=db_session)
 
         # update chat titles for later use
-        if settings.AUTOUPDATE_CHAT_TITLES:
-            for rg in enabled_groups:
-                actual_title = context.bot.get_chat(rg.chat_id)
-                if rg.update_title(actual_title):
-                    db_session.add(rg)
+        for rg in enabled_groups:
+            if rg.chat_id in actual_titles and rg.update_title(
+                actual_titles[rg.chat_id]
+            ):
+                db_session.add(rg)
 
-        filtered_receiver_groups = (
-            rg
-            for rg in enabled_groups
-            if restrictive_tags <= rg.tags_set and extending_tags & rg.tags_set
+        filtered_receiver_groups = rules.select_receivers(
+            enabled_groups,
+            post_tags=post_tags,
+            expression_of=lambda rg: rg.rule_expression,
         )
         for rg in filtered_receiver_groups:
+            receiver = {"title": rg.title, "chat_id": rg.chat_id, "dbid": rg.id}
+            if rg.is_digest:
+                DigestEntry.add(
+                    chat_id=rg.chat_id,
+                    message_id=post.message_id,
+                    link=post.link,
+                    tags=post_tags,
+                    session=db_session,
+                )
+                digest_receivers_list.append(receiver)
+            else:
+                receivers_list.append(receiver)
+
+    copies = []
+    budget = storage.BotData.get_rate_budget(context.bot_data)
+    with budget.live():
+        for receiver in receivers_list:
             if settings.SLOW_MODE:
                 time.sleep(settings.SLOW_MODE_DELAY)
 
-            _forward_post(receiver_group=rg, update=update, context=context)
-            receivers_list.append(
-                {"title": rg.title, "chat_id": rg.chat_id, "dbid": rg.id}
+            budget.record()
+            forwarded = _forward_post(
+                receiver["chat_id"], receiver["title"], update=update, context=context
             )
+            if forwarded is not None:
+                copies.append((receiver["chat_id"], forwarded.message_id))
+
+    if copies:
+        with db_session_from_context(context) as db_session:
+            for chat_id, message_id in copies:
+                DeliveredCopy.record(
+                    source_message_id=post.message_id,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    session=db_session,
+                )
 
     # conclusion:
     # -----------
@@ -434,9 +866,246 @@ def handler_broadcast_post(update: Update, context: CallbackContext) -> None:
     else:
         log_msg = log_msg_prefix + "Post was not forwarded anywhere!"
         tg_msg = tg_msg_prefix + "Post was not forwarded into any chats."
+    if len(digest_receivers_list) > 0:
+        log_msg += f" Post was queued for digest in {len(digest_receivers_list)} chat(s): {digest_receivers_list}"
+        tg_msg += (
+            f"\nPost was queued for digest in {len(digest_receivers_list)} chat(s):\n"
+            + "\n".join(
+                f" * `{tg_dict['title']}` tg#{tg_dict['chat_id']}"
+                for tg_dict in digest_receivers_list
+            )
+        )
     logger.info(log_msg)
     if settings.LOG_REPLIES:
         # Telegram limits message to 4096 unicode code points
         messages = [tg_msg[i:i + 4096] for i in range(0, len(tg_msg), 4096)]
         for msg in messages:
             post.reply_text(msg)
+
+
+def handler_propagate_edit(update: Update, context: CallbackContext) -> None:
+    """Re-route edited post from channel.
+
+    Forwarded messages can not be edited, so copies in still matching groups are
+    deleted and forwarded again, copies in groups which no longer match are deleted,
+    and newly matching groups get the post like on broadcast.
+    Edits which changed neither content nor tags are ignored.
+    """
+    post = update.effective_message
+    logger.debug(
+        f'Edited post #{post.message_id} in "{update.effective_chat.title}" tg#{update.effective_chat.id} channel.'
+    )
+    if not settings.PROPAGATE_EDITS:
+        return
+
+    post_tags = frozenset(
+        t.lower()
+        for t in _extract_hashtags(
+            message=post,
+            allowed_hashtags=settings.ALL_TAGS,
+        )
+    )
+    content_hash = _content_hash(post)
+
+    with db_session_from_context(context) as db_session:
+        source_post = SourcePost.get_by_message_id(post.message_id, session=db_session)
+        # unknown post (e.g. older than backfill window) is only re-forwarded
+        previous_tags = None
+        if source_post is not None:
+            if source_post.content_hash == content_hash:
+                logger.debug(f"Edited post #{post.message_id} has not changed.")
+                return
+            previous_tags = source_post.tags_set
+        SourcePost.record(
+            message_id=post.message_id,
+            tags=post_tags,
+            link=post.link,
+            content_hash=content_hash,
+            session=db_session,
+        )
+
+        enabled_groups = ReceiverGroup.list_enabled(session=db_session)
+        matched = rules.select_receivers(
+            enabled_groups,
+            post_tags=post_tags,
+            expression_of=lambda rg: rg.rule_expression,
+        )
+        matched_chat_ids = {rg.chat_id for rg in matched}
+        previously_matched_chat_ids = set()
+        if previous_tags is not None:
+            previously_matched_chat_ids = {
+                rg.chat_id
+                for rg in rules.select_receivers(
+                    enabled_groups,
+                    post_tags=previous_tags,
+                    expression_of=lambda rg: rg.rule_expression,
+                )
+            }
+        enabled_chat_ids = {rg.chat_id for rg in enabled_groups}
+
+        titles = {rg.chat_id: rg.title for rg in enabled_groups}
+        copies = DeliveredCopy.list_for_source(post.message_id, session=db_session)
+        to_replace = [
+            (c.id, c.chat_id, c.message_id)
+            for c in copies
+            if c.chat_id in matched_chat_ids
+        ]
+        # copies in disabled groups are left as they are
+        to_retract = [
+            (c.id, c.chat_id, c.message_id)
+            for c in copies
+            if c.chat_id in enabled_chat_ids and c.chat_id not in matched_chat_ids
+        ]
+        copy_chat_ids = {c.chat_id for c in copies}
+        to_forward = []
+        newly_matched = [
+            rg
+            for rg in matched
+            if previous_tags is not None
+            and rg.chat_id not in previously_matched_chat_ids
+        ]
+        for rg in newly_matched:
+            if rg.is_digest:
+                DigestEntry.add(
+                    chat_id=rg.chat_id,
+                    message_id=post.message_id,
+                    link=post.link,
+                    tags=post_tags,
+                    session=db_session,
+                )
+            elif rg.chat_id not in copy_chat_ids:
+                to_forward.append((rg.chat_id, rg.title))
+        undigested = DigestEntry.delete_by_message_id(
+            post.message_id,
+            chat_ids=previously_matched_chat_ids - matched_chat_ids,
+            session=db_session,
+        )
+
+    stale_copy_ids = []
+    to_reforward = []
+    copies = []
+    budget = storage.BotData.get_rate_budget(context.bot_data)
+    with budget.live():
+        replace_copy_ids = {copy_id for copy_id, _, _ in to_replace}
+        for copy_id, chat_id, message_id in to_replace + to_retract:
+            if settings.SLOW_MODE:
+                time.sleep(settings.SLOW_MODE_DELAY)
+
+            budget.record()
+            if not _delete_message(
+                _delivery_bot(context), chat_id=chat_id, message_id=message_id
+            ):
+                # keep tracking the copy, so it is not duplicated and can be retracted
+                logger.warning(
+                    f"Copy {message_id} of edited post #{post.message_id} in chat "
+                    f"{chat_id} was not deleted, keeping it as is."
+                )
+                continue
+            stale_copy_ids.append(copy_id)
+            if copy_id in replace_copy_ids:
+                to_reforward.append((chat_id, titles[chat_id]))
+
+        for chat_id, title in to_reforward + to_forward:
+            if settings.SLOW_MODE:
+                time.sleep(settings.SLOW_MODE_DELAY)
+
+            budget.record()
+            forwarded = _forward_post(chat_id, title, update=update, context=context)
+            if forwarded is not None:
+                copies.append((chat_id, forwarded.message_id))
+
+    if stale_copy_ids or copies:
+        with db_session_from_context(context) as db_session:
+            DeliveredCopy.delete_by_ids(stale_copy_ids, session=db_session)
+            for chat_id, message_id in copies:
+                DeliveredCopy.record(
+                    source_message_id=post.message_id,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    session=db_session,
+                )
+
+    logger.info(
+        f"Edited post #{post.message_id} was re-forwarded into {len(copies)} chat(s): "
+        f"{len(to_reforward)} of {len(to_replace)} replaced, {len(to_forward)} new; "
+        f"retracted from {len(stale_copy_ids) - len(to_reforward)} of "
+        f"{len(to_retract)} chat(s) and {undigested} pending digest(s)."
+    )
+
+
+def command_retract(update: Update, context: CallbackContext) -> None:
+    """Delete all delivered copies of a source channel post."""
+    logger.debug(f"Command /retract from {update.effective_chat.id} chat.")
+
+    try:
+        # accept both post ID and post link, e.g. https://t.me/c/1234567890/42
+        message_id = int(context.args[0].rstrip("/").rsplit("/", 1)[-1])
+    except (IndexError, ValueError):
+        update.effective_message.reply_text(
+            "Pass ID or link of the source channel post: /retract 42"
+        )
+        return
+
+    with db_session_from_context(context) as db_session:
+        copies = DeliveredCopy.list_for_source(message_id, session=db_session)
+        DeliveredCopy.delete_by_ids([c.id for c in copies], session=db_session)
+        copies = [(c.chat_id, c.message_id) for c in copies]
+        # make sure post is not delivered later
+        undigested = DigestEntry.delete_by_message_id(message_id, session=db_session)
+        SourcePost.delete_by_message_id(message_id, session=db_session)
+    unqueued = storage.BotData.get_backfill_queue(context.bot_data).discard_message(
+        message_id
+    )
+
+    retracted = 0
+    budget = storage.BotData.get_rate_budget(context.bot_data)
+    with budget.live():
+        for chat_id, copy_message_id in copies:
+            if settings.SLOW_MODE:
+                time.sleep(settings.SLOW_MODE_DELAY)
+
+            budget.record()
+            if _delete_message(
+                _delivery_bot(context), chat_id=chat_id, message_id=copy_message_id
+            ):
+                retracted += 1
+
+    reply_msg = (
+        f"Post #{message_id} was deleted from {retracted} of {len(copies)} chat(s).\n"
+        f"Removed from {undigested} pending digest(s) and {unqueued} pending backfill(s)."
+    )
+    logger.info(reply_msg)
+    update.effective_message.reply_text(reply_msg)
+
+
+def command_route(update: Update, context: CallbackContext) -> None:
+    """Report receivers and broadcast cost of a post without sending it."""
+    logger.debug(f"Command /route from {update.effective_chat.id} chat.")
+
+    # receiver counts to estimate follow "|", so numeric tags stay tags
+    text, _, counts = " ".join(context.args).partition("|")
+    try:
+        what_if = [int(c) for c in counts.split()]
+    except ValueError:
+        what_if = None
+    if not text.strip() or what_if is None:
+        update.effective_message.reply_text(
+            'Pass sample post text or tags, optionally followed by "|" and '
+            "receiver counts to estimate: /route #python #remote | 1000 10000"
+        )
+        return
+
+    forward_latency = _delivery_bot(context).request.average_latency("forwardMessage")
+    # chat titles are fetched by the bot which receives channel posts
+    title_latency = context.bot.request.average_latency("getChat")
+    with db_session_from_context(context) as db_session:
+        plan = route.plan_route(
+            route.extract_tags(text),
+            session=db_session,
+            forward_latency=forward_latency or settings.ROUTE_FORWARD_LATENCY,
+            title_latency=title_latency,
+            what_if=what_if,
+        )
+        reply_msg = route.format_plan(plan)
+
+    update.effective_message.reply_text(reply_msg)
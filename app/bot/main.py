@@ -5,6 +5,8 @@ from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 from . import dbadapter
 from . import handlers
 from . import settings
+from . import transport
+from .delivery import RateBudget, DeliveryQueue
 from .storage import BotData
 
 # Enable logging
@@ -24,8 +26,18 @@ def main():
         settings.SOURCE_CHANNEL
     )
 
-    # Create the Updater and pass it your bot's token.
-    updater = Updater(settings.TGBOT_APIKEY)
+    # Create the Updater with separate connection pools
+    # for polling/replies and for delivery to receiver groups
+    polling_request = transport.make_request(
+        "polling", con_pool_size=settings.POLLING_POOL_SIZE
+    )
+    delivery_request = transport.make_request(
+        "delivery", con_pool_size=settings.DELIVERY_POOL_SIZE
+    )
+    updater = Updater(
+        bot=transport.make_bot(polling_request),
+        workers=settings.WORKERS,
+    )
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
@@ -39,6 +51,20 @@ def main():
             "start", handlers.command_start, filters=Filters.chat_type.private
         )
     )
+    dispatcher.add_handler(
+        CommandHandler(
+            "retract",
+            handlers.command_retract,
+            filters=filter_admins & Filters.chat_type.private,
+        )
+    )
+    dispatcher.add_handler(
+        CommandHandler(
+            "route",
+            handlers.command_route,
+            filters=filter_admins & Filters.chat_type.private,
+        )
+    )
     # ----
     # Group commands
     dispatcher.add_handler(
@@ -69,6 +95,13 @@ def main():
             filters=filter_admins & filter_groups,
         )
     )
+    dispatcher.add_handler(
+        CommandHandler(
+            "delivery",
+            handlers.command_delivery,
+            filters=filter_admins & filter_groups,
+        )
+    )
     dispatcher.add_handler(
         CommandHandler(
             "enable",
@@ -87,15 +120,42 @@ def main():
     # Handle channel posts
     dispatcher.add_handler(
         MessageHandler(
-            filters=filter_channel,
+            filters=filter_channel & Filters.update.channel_post,
             callback=handlers.handler_broadcast_post,
         )
     )
+    dispatcher.add_handler(
+        MessageHandler(
+            filters=filter_channel & Filters.update.edited_channel_post,
+            callback=handlers.handler_propagate_edit,
+        )
+    )
 
     # Initialize DB
     session_maker = dbadapter.init_sessionmaker()
     dispatcher.bot_data[BotData.DB_SESSION_MAKER] = session_maker
 
+    # Initialize delivery state shared by handlers and background jobs
+    dispatcher.bot_data[BotData.RATE_BUDGET] = RateBudget(
+        rate_limit=settings.RATE_LIMIT,
+        background_share=settings.BACKGROUND_RATE_SHARE,
+    )
+    dispatcher.bot_data[BotData.BACKFILL_QUEUE] = DeliveryQueue()
+    dispatcher.bot_data[BotData.DELIVERY_BOT] = transport.make_bot(delivery_request)
+
+    # Schedule background jobs
+    if settings.BACKFILL:
+        updater.job_queue.run_repeating(
+            handlers.job_backfill,
+            interval=settings.BACKFILL_INTERVAL,
+            name="backfill",
+        )
+    updater.job_queue.run_repeating(
+        handlers.job_flush_digests,
+        interval=settings.DIGEST_CHECK_INTERVAL,
+        name="flush_digests",
+    )
+
     # Start the Bot
     updater.start_polling()
 
@@ -103,3 +163,7 @@ def main():
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
+
+    for request in (polling_request, delivery_request):
+        logger.info(f"Transport stats:\n{transport.format_stats(request.stats())}")
+    delivery_request.stop()
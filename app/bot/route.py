@@ -0,0 +1,191 @@
+"""Dry-run routing of a post and broadcast cost estimation.
+
+Usage: python -m bot.route "#python #remote New vacancy" --what-if 1000 --what-if 10000
+"""
+import argparse
+import re
+import time
+from dataclasses import dataclass, field
+from typing import FrozenSet, Iterable, List, Optional
+
+from . import dbadapter, rules, settings
+
+HASHTAG_RE = re.compile(r"#(\w+)")
+
+
+def extract_tags(text: str) -> FrozenSet[str]:
+    """Extract allowed tags from sample post text, or from bare tag list without "#"."""
+    if "#" in text:
+        candidates = HASHTAG_RE.findall(text)
+    else:
+        candidates = re.split(r"[\s,]+", text)
+    return frozenset(t.lower() for t in candidates if t.lower() in settings.ALL_TAGS)
+
+
+def forward_cost(forward_latency: float) -> float:
+    """Seconds per forward in a broadcast loop under current settings."""
+    cost = forward_latency
+    if settings.SLOW_MODE:
+        cost += settings.SLOW_MODE_DELAY
+    return max(cost, 1 / settings.RATE_LIMIT)
+
+
+@dataclass
+class WhatIf:
+    receivers: int
+    matched: int
+    selection_seconds: float
+    delivery_seconds: float
+
+
+@dataclass
+class RoutePlan:
+    post_tags: FrozenSet[str]
+    enabled: int
+    forward_receivers: List[dbadapter.ReceiverGroup]
+    digest_receivers: List[dbadapter.ReceiverGroup]
+    query_seconds: float
+    selection_seconds: float
+    forward_cost: float
+    # getChat per enabled chat when chat titles are auto-updated
+    title_cost: float
+    what_if: List[WhatIf] = field(default_factory=list)
+
+    @property
+    def matched(self) -> int:
+        return len(self.forward_receivers) + len(self.digest_receivers)
+
+    @property
+    def titles_seconds(self) -> float:
+        return self.enabled * self.title_cost
+
+    @property
+    def delivery_seconds(self) -> float:
+        return self.titles_seconds + len(self.forward_receivers) * self.forward_cost
+
+
+def plan_route(
+    post_tags: FrozenSet[str],
+    *,
+    session: dbadapter.Session,
+    forward_latency: float,
+    title_latency: Optional[float] = None,
+    what_if: Iterable[int] = (),
+) -> RoutePlan:
+    """Select receivers like handler_broadcast_post does, without sending anything.
+
+    ``title_latency`` is getChat latency, same as ``forward_latency`` if not given.
+    """
+    start = time.perf_counter()
+    enabled_groups = dbadapter.ReceiverGroup.list_enabled(session=session)
+    query_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    selected = rules.select_receivers(
+        enabled_groups,
+        post_tags=post_tags,
+        expression_of=lambda rg: rg.rule_expression,
+    )
+    selection_seconds = time.perf_counter() - start
+
+    # broadcast fetches title of each enabled chat before forwarding
+    title_cost = 0.0
+    if settings.AUTOUPDATE_CHAT_TITLES:
+        title_cost = forward_latency if title_latency is None else title_latency
+
+    plan = RoutePlan(
+        post_tags=post_tags,
+        enabled=len(enabled_groups),
+        forward_receivers=[rg for rg in selected if not rg.is_digest],
+        digest_receivers=[rg for rg in selected if rg.is_digest],
+        query_seconds=query_seconds,
+        selection_seconds=selection_seconds,
+        forward_cost=forward_cost(forward_latency),
+        title_cost=title_cost,
+    )
+
+    # scale current match ratio and selection time to other receiver counts
+    for receivers in what_if:
+        ratio = receivers / plan.enabled if plan.enabled else 0
+        plan.what_if.append(
+            WhatIf(
+                receivers=receivers,
+                matched=round(plan.matched * ratio),
+                selection_seconds=selection_seconds * ratio,
+                delivery_seconds=receivers * plan.title_cost
+                + round(len(plan.forward_receivers) * ratio) * plan.forward_cost,
+            )
+        )
+    return plan
+
+
+def format_plan(plan: RoutePlan) -> str:
+    lines = [
+        f"Detected (allowed) tags: {' , '.join(sorted(plan.post_tags)) or '<none>'}",
+        f"Matched {plan.matched} of {plan.enabled} enabled chat(s): "
+        f"{len(plan.forward_receivers)} forward, {len(plan.digest_receivers)} digest",
+        f"Receivers query: {plan.query_seconds * 1000:.1f}ms, "
+        f"selection: {plan.selection_seconds * 1000:.1f}ms",
+        f"Estimated broadcast time: {plan.delivery_seconds:.1f}s "
+        f"({plan.forward_cost:.3f}s per forward)",
+    ]
+    if plan.title_cost:
+        lines.append(
+            f"Including chat titles update: {plan.titles_seconds:.1f}s "
+            f"({plan.title_cost:.3f}s per enabled chat)"
+        )
+    if plan.what_if:
+        lines.append("What if:")
+        for w in plan.what_if:
+            lines.append(
+                f" * {w.receivers} enabled chat(s): ~{w.matched} matched, "
+                f"selection {w.selection_seconds * 1000:.1f}ms, "
+                f"broadcast {w.delivery_seconds:.1f}s"
+            )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Dry-run routing of a post and broadcast cost estimation."
+    )
+    parser.add_argument("text", nargs="+", help="sample post text or tags")
+    parser.add_argument(
+        "--what-if",
+        type=int,
+        action="append",
+        default=[],
+        metavar="RECEIVERS",
+        help="estimate for given number of enabled chats (repeatable)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=settings.ROUTE_FORWARD_LATENCY,
+        help="expected forwardMessage latency in seconds",
+    )
+    parser.add_argument(
+        "--title-latency",
+        type=float,
+        default=None,
+        help="expected getChat latency in seconds (defaults to --latency)",
+    )
+    parser.add_argument("--db-uri", default=None)
+    args = parser.parse_args(argv)
+
+    db_session = dbadapter.make_session(db_uri=args.db_uri)
+    try:
+        plan = plan_route(
+            extract_tags(" ".join(args.text)),
+            session=db_session,
+            forward_latency=args.latency,
+            title_latency=args.title_latency,
+            what_if=args.what_if,
+        )
+    finally:
+        db_session.close()
+    print(format_plan(plan))
+
+
+if __name__ == "__main__":
+    main()
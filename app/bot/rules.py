@@ -0,0 +1,231 @@
+"""Boolean subscription rules, e.g. ``(python | go) & remote & !intern``.
+
+Grammar (``!`` binds tighter than ``&``, which binds tighter than ``|``)::
+
+    or   := and ("|" and)*
+    and  := not ("&" not)*
+    not  := "!" not | atom
+    atom := TAG | "(" or ")"
+
+Empty expression matches nothing.
+"""
+import functools
+import re
+from typing import Callable, FrozenSet, Iterable, List, Tuple, TypeVar
+
+Predicate = Callable[[FrozenSet[str]], bool]
+
+# AST nodes are tuples: ("tag", name), ("not", node), ("and", [nodes]), ("or", [nodes])
+Node = tuple
+
+TOKEN_RE = re.compile(r"\s*(?:(?P<op>[()!&|])|#?(?P<tag>[\w-]+))")
+
+
+class RuleError(ValueError):
+    pass
+
+
+def _tokenize(expression: str) -> List[Tuple[str, str]]:
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = TOKEN_RE.match(expression, pos)
+        if match is None:
+            raise RuleError(f"Unexpected character {expression[pos:].strip()[0]!r}")
+        if match.group("op"):
+            tokens.append(("op", match.group("op")))
+        else:
+            tokens.append(("tag", match.group("tag").lower()))
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, tokens: List[Tuple[str, str]]):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self) -> Tuple[str, str] or None:
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def accept(self, op: str) -> bool:
+        if self.peek() == ("op", op):
+            self.pos += 1
+            return True
+        return False
+
+    def parse(self) -> Node:
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise RuleError(f"Unexpected {self.peek()[1]!r}")
+        return node
+
+    def parse_or(self) -> Node:
+        nodes = [self.parse_and()]
+        while self.accept("|"):
+            nodes.append(self.parse_and())
+        return _flatten("or", nodes)
+
+    def parse_and(self) -> Node:
+        nodes = [self.parse_not()]
+        while self.accept("&"):
+            nodes.append(self.parse_not())
+        return _flatten("and", nodes)
+
+    def parse_not(self) -> Node:
+        if self.accept("!"):
+            return ("not", self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self) -> Node:
+        token = self.peek()
+        if token is None:
+            raise RuleError("Unexpected end of expression")
+        if token[0] == "tag":
+            self.pos += 1
+            return ("tag", token[1])
+        if self.accept("("):
+            node = self.parse_or()
+            if not self.accept(")"):
+                raise RuleError("Missing closing parenthesis")
+            return node
+        raise RuleError(f"Unexpected {token[1]!r}")
+
+
+def _flatten(op: str, nodes: List[Node]) -> Node:
+    if len(nodes) == 1:
+        return nodes[0]
+    flat = []
+    for node in nodes:
+        flat.extend(node[1] if node[0] == op else [node])
+    return (op, flat)
+
+
+def parse(expression: str) -> Node or None:
+    """Parse expression into AST, ``None`` for empty expression."""
+    tokens = _tokenize(expression)
+    if not tokens:
+        return None
+    return _Parser(tokens).parse()
+
+
+def _format(node: Node, parent: str = "or") -> str:
+    kind = node[0]
+    if kind == "tag":
+        return node[1]
+    if kind == "not":
+        return "!" + _format(node[1], parent="not")
+    s = f" {'|' if kind == 'or' else '&'} ".join(
+        _format(n, parent=kind) for n in node[1]
+    )
+    # wrap "or" inside "and"/"not", and "and" inside "not"
+    if (kind, parent) in {("or", "and"), ("or", "not"), ("and", "not")}:
+        return f"({s})"
+    return s
+
+
+def normalize(expression: str) -> str:
+    """Return canonical form of the expression, raise RuleError if it is invalid."""
+    node = parse(expression)
+    return "" if node is None else _format(node)
+
+
+def _collect_tags(node: Node) -> FrozenSet[str]:
+    if node[0] == "tag":
+        return frozenset({node[1]})
+    if node[0] == "not":
+        return _collect_tags(node[1])
+    return frozenset().union(*(_collect_tags(n) for n in node[1]))
+
+
+def referenced_tags(expression: str) -> FrozenSet[str]:
+    node = parse(expression)
+    return frozenset() if node is None else _collect_tags(node)
+
+
+def _collect_positive_tags(node: Node, negated: bool = False) -> FrozenSet[str]:
+    if node[0] == "tag":
+        return frozenset() if negated else frozenset({node[1]})
+    if node[0] == "not":
+        return _collect_positive_tags(node[1], negated=not negated)
+    return frozenset().union(*(_collect_positive_tags(n, negated) for n in node[1]))
+
+
+def positive_tags(expression: str) -> FrozenSet[str]:
+    """Tags referenced by the expression outside of negations."""
+    node = parse(expression)
+    return frozenset() if node is None else _collect_positive_tags(node)
+
+
+def _compile(node: Node) -> Predicate:
+    kind = node[0]
+    if kind == "tag":
+        name = node[1]
+        return lambda tags: name in tags
+    if kind == "not":
+        inner = _compile(node[1])
+        return lambda tags: not inner(tags)
+    predicates = tuple(_compile(n) for n in node[1])
+    if kind == "and":
+        return lambda tags: all(p(tags) for p in predicates)
+    return lambda tags: any(p(tags) for p in predicates)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_rule(expression: str) -> Predicate:
+    """Compile expression into predicate over a set of post tags.
+
+    Compiled predicates are cached, so groups sharing an expression share the predicate.
+    """
+    node = parse(expression)
+    if node is None:
+        return lambda tags: False
+    return _compile(node)
+
+
+@functools.lru_cache(maxsize=4096)
+def tags_to_expression(
+    tags: FrozenSet[str],
+    extending_tags: FrozenSet[str],
+    restrictive_tags: FrozenSet[str],
+) -> str:
+    """Express legacy extending/restrictive tag subscription as a rule.
+
+    Legacy semantics: post is delivered when group is subscribed to any of post's
+    extending tags, and to all of post's restrictive tags.
+    """
+    extending = sorted(tags & extending_tags)
+    if not extending:
+        return ""
+    excluded = sorted(restrictive_tags - tags)
+    expression = " | ".join(extending)
+    if excluded:
+        if len(extending) > 1:
+            expression = f"({expression})"
+        expression = " & ".join([expression, *(f"!{t}" for t in excluded)])
+    return expression
+
+
+T = TypeVar("T")
+
+
+def select_receivers(
+    receivers: Iterable[T],
+    post_tags: FrozenSet[str],
+    expression_of: Callable[[T], str],
+) -> List[T]:
+    """Filter receivers whose rule matches post tags.
+
+    Each distinct expression is evaluated only once per post.
+    """
+    decisions = {}
+    selected = []
+    for receiver in receivers:
+        expression = expression_of(receiver)
+        decision = decisions.get(expression)
+        if decision is None:
+            decision = decisions[expression] = compile_rule(expression)(post_tags)
+        if decision:
+            selected.append(receiver)
+    return selected
@@ -1,5 +1,5 @@
 import os
-from typing import FrozenSet, List
+from typing import Dict, FrozenSet, List
 
 import environ
 
@@ -18,6 +18,12 @@ def parse_tags(tags_string: str) -> FrozenSet[str]:
     return frozenset(tags)
 
 
+def parse_timeouts(timeouts_string: str) -> Dict[str, float]:
+    # "method=seconds" pairs separated by comma
+    pairs = (p.split("=", 1) for p in timeouts_string.split(",") if p)
+    return {method.strip(): float(seconds) for method, seconds in pairs}
+
+
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 ENV_FILE = os.path.join(BASE_DIR, ".env")
 
@@ -44,3 +50,49 @@ LOG_REPLIES = env.bool("TGBOT_LOG_REPLIES", default=False)
 POST_EXTENDING_TAGS = parse_tags(env.str("TGBOT_POST_EXTENDING_TAGS", default=""))
 POST_RESTRICTIVE_TAGS = parse_tags(env.str("TGBOT_POST_RESTRICTIVE_TAGS", default=""))
 ALL_TAGS = POST_EXTENDING_TAGS | POST_RESTRICTIVE_TAGS
+
+# Shared Bot API rate limit (calls per second), background jobs only use spare budget
+RATE_LIMIT = env.float("TGBOT_RATE_LIMIT", default=30.0)
+BACKGROUND_RATE_SHARE = env.float("TGBOT_BACKGROUND_RATE_SHARE", default=0.5)
+
+BACKFILL = env.bool("TGBOT_BACKFILL", default=True)
+BACKFILL_WINDOW_HOURS = env.float("TGBOT_BACKFILL_WINDOW_HOURS", default=24.0)
+BACKFILL_INTERVAL = env.float("TGBOT_BACKFILL_INTERVAL", default=1.0)
+
+# Receivers in digest delivery mode get one message per interval with links to posts
+DIGEST_INTERVAL_MINUTES = env.float("TGBOT_DIGEST_INTERVAL_MINUTES", default=60.0)
+DIGEST_CHECK_INTERVAL = env.float("TGBOT_DIGEST_CHECK_INTERVAL", default=60.0)
+DIGEST_BATCH_SIZE = env.int("TGBOT_DIGEST_BATCH_SIZE", default=20)
+DIGEST_MAX_ATTEMPTS = env.int("TGBOT_DIGEST_MAX_ATTEMPTS", default=5)
+
+# How long (in hours) delivered copies are tracked for edits and retraction
+# Note: bots can delete messages in group chats only within 48 hours
+COPIES_RETENTION_HOURS = env.float("TGBOT_COPIES_RETENTION_HOURS", default=48.0)
+PROPAGATE_EDITS = env.bool("TGBOT_PROPAGATE_EDITS", default=True)
+
+# Bot API transport: polling and delivery use separate connection pools
+WORKERS = env.int("TGBOT_WORKERS", default=4)
+# python-telegram-bot requires at least 4 connections on top of the number of workers
+POLLING_POOL_SIZE = env.int("TGBOT_POLLING_POOL_SIZE", default=WORKERS + 4)
+# handlers (one per worker) and job queue can deliver concurrently
+DELIVERY_POOL_SIZE = env.int("TGBOT_DELIVERY_POOL_SIZE", default=WORKERS + 2)
+HTTP_CONNECT_TIMEOUT = env.float("TGBOT_HTTP_CONNECT_TIMEOUT", default=5.0)
+HTTP_READ_TIMEOUT = env.float("TGBOT_HTTP_READ_TIMEOUT", default=5.0)
+# Per-method read timeouts, e.g. "forwardMessage=10,sendMessage=10"
+HTTP_METHOD_TIMEOUTS = parse_timeouts(env.str("TGBOT_HTTP_METHOD_TIMEOUTS", default=""))
+
+# Expected forwardMessage latency used by /route estimates until it is measured
+ROUTE_FORWARD_LATENCY = env.float("TGBOT_ROUTE_FORWARD_LATENCY", default=0.1)
+
+# DB engine: one per DB_URI, shared by handlers, jobs and utility functions
+DB_POOL_SIZE = env.int("DB_POOL_SIZE", default=5)
+DB_MAX_OVERFLOW = env.int("DB_MAX_OVERFLOW", default=10)
+DB_POOL_PRE_PING = env.bool("DB_POOL_PRE_PING", default=True)
+DB_SQLITE_WAL = env.bool("DB_SQLITE_WAL", default=True)
+DB_SQLITE_SYNCHRONOUS = env.str("DB_SQLITE_SYNCHRONOUS", default="NORMAL")
+DB_SQLITE_BUSY_TIMEOUT = env.float("DB_SQLITE_BUSY_TIMEOUT", default=5.0)
+# PostgreSQL statement timeout in seconds, 0 to disable
+DB_STATEMENT_TIMEOUT = env.float("DB_STATEMENT_TIMEOUT", default=0)
+DB_SLOW_QUERY_SECONDS = env.float("DB_SLOW_QUERY_SECONDS", default=0.5)
+# DB time of one session: pool checkout, queries and commit
+DB_SLOW_SESSION_SECONDS = env.float("DB_SLOW_SESSION_SECONDS", default=2.0)
@@ -1,9 +1,15 @@
+from telegram import Bot
+
 from bot import dbadapter
+from bot.delivery import RateBudget, DeliveryQueue
 
 
 class BotData:
     DB_SESSION = "db_session"
     DB_SESSION_MAKER = "db_session_maker"
+    RATE_BUDGET = "rate_budget"
+    BACKFILL_QUEUE = "backfill_queue"
+    DELIVERY_BOT = "delivery_bot"
 
     @classmethod
     def get_db_session(cls, bot_data: dict) -> dbadapter.Session:
@@ -12,3 +18,15 @@ class BotData:
     @classmethod
     def get_db_session_maker(cls, bot_data: dict) -> dbadapter.sessionmaker:
         return bot_data[cls.DB_SESSION_MAKER]
+
+    @classmethod
+    def get_rate_budget(cls, bot_data: dict) -> RateBudget:
+        return bot_data[cls.RATE_BUDGET]
+
+    @classmethod
+    def get_backfill_queue(cls, bot_data: dict) -> DeliveryQueue:
+        return bot_data[cls.BACKFILL_QUEUE]
+
+    @classmethod
+    def get_delivery_bot(cls, bot_data: dict) -> Bot:
+        return bot_data[cls.DELIVERY_BOT]
@@ -0,0 +1,113 @@
+import threading
+import time
+from typing import Dict, Optional
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+from . import settings
+
+
+class TimedRequest(Request):
+    """Bot API transport with per-method timeouts and usage stats.
+
+    Connections are kept alive in the pool (``con_pool_size`` connections per host),
+    so a pool sized for the expected concurrency does not open new TLS connections
+    for each burst of requests.
+    """
+
+    __slots__ = ("name", "method_timeouts", "_calls", "_latency", "_stats_lock")
+
+    def __init__(
+        self,
+        name: str,
+        con_pool_size: int,
+        method_timeouts: Optional[Dict[str, float]] = None,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 5.0,
+    ):
+        super().__init__(
+            con_pool_size=con_pool_size,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+        )
+        self.name = name
+        self.method_timeouts = method_timeouts or {}
+        self._calls: Dict[str, int] = {}
+        self._latency: Dict[str, float] = {}
+        self._stats_lock = threading.Lock()
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        method = url.rsplit("/", 1)[-1]
+        if timeout is None:
+            timeout = self.method_timeouts.get(method)
+        start = time.perf_counter()
+        try:
+            return super().post(url, data, timeout=timeout)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._stats_lock:
+                self._calls[method] = self._calls.get(method, 0) + 1
+                self._latency[method] = self._latency.get(method, 0.0) + elapsed
+
+    def average_latency(self, method: str) -> Optional[float]:
+        with self._stats_lock:
+            calls = self._calls.get(method)
+            if not calls:
+                return None
+            return self._latency[method] / calls
+
+    def stats(self) -> dict:
+        """Requests and latency per method, and connection reuse of the pool."""
+        connections = requests = 0
+        pools = getattr(self._con_pool, "pools", None)
+        if pools is not None:
+            for key in pools.keys():
+                pool = pools[key]
+                connections += pool.num_connections
+                requests += pool.num_requests
+        with self._stats_lock:
+            methods = {
+                method: {
+                    "calls": calls,
+                    "avg_latency": self._latency[method] / calls,
+                }
+                for method, calls in self._calls.items()
+            }
+        return {
+            "name": self.name,
+            "pool_size": self.con_pool_size,
+            "connections": connections,
+            "requests": requests,
+            "reuse": 1 - connections / requests if requests else None,
+            "methods": methods,
+        }
+
+
+def make_request(name: str, con_pool_size: int) -> TimedRequest:
+    return TimedRequest(
+        name=name,
+        con_pool_size=con_pool_size,
+        method_timeouts=settings.HTTP_METHOD_TIMEOUTS,
+        connect_timeout=settings.HTTP_CONNECT_TIMEOUT,
+        read_timeout=settings.HTTP_READ_TIMEOUT,
+    )
+
+
+def make_bot(request: TimedRequest) -> Bot:
+    return Bot(settings.TGBOT_APIKEY, request=request)
+
+
+def format_stats(stats: dict) -> str:
+    reuse = "n/a" if stats["reuse"] is None else f"{stats['reuse']:.0%}"
+    lines = [
+        f"{stats['name']}: pool={stats['pool_size']} "
+        f"requests={stats['requests']} connections={stats['connections']} "
+        f"reuse={reuse}"
+    ]
+    for method, method_stats in sorted(stats["methods"].items()):
+        lines.append(
+            f"  {method}: calls={method_stats['calls']} "
+            f"avg={method_stats['avg_latency'] * 1000:.0f}ms"
+        )
+    return "\n".join(lines)